@@ -1,24 +1,38 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, g, abort, make_response
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time, timezone
 import os
 from functools import wraps
-from sqlalchemy import func
+from collections import namedtuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time as time_module
+from sqlalchemy import func, or_, and_, select, insert, update, delete, case, cast, event, bindparam, inspect, text
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, contains_eager, validates, Session
 import io
+import csv
+import hashlib
+import json
+import sqlite3
+import sys
+from types import MappingProxyType
 import pandas as pd
+from jinja2 import FileSystemBytecodeCache
 
 
 # --- timezone (safe) ---
 try:
     from zoneinfo import ZoneInfo
     OSLO_TZ = ZoneInfo("Europe/Oslo")
-    UTC_TZ = ZoneInfo("UTC")
 except Exception:
     # If tzdata is missing, ZoneInfo("Europe/Oslo") fails on some systems.
     OSLO_TZ = None
-    UTC_TZ = None
 
 
 # -------------------- APP CONFIG --------------------
@@ -29,6 +43,10 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "FYS8gh49g4jgjS6h4hG4sjg4g4g4")
 app.config['WTF_CSRF_SECRET_KEY'] = os.getenv("WTF_CSRF_SECRET_KEY", "g8GJg48gjGjg48gj48jg93jg")
 
+# Maler sjekkes bare for endringer i lokal utvikling (FLASK_DEBUG=1). Ellers blir de
+# kompilerte malene liggende i Jinja-cachen uten en mtime-sjekk per rendering.
+app.config['TEMPLATES_AUTO_RELOAD'] = os.getenv("FLASK_DEBUG") == "1"
+
 # --- Database setup (Render + local) ---
 # On Render: uses DATABASE_URL (Postgres)
 # Locally: falls back to SQLite file loan_system.db
@@ -41,8 +59,38 @@ if db_url.startswith("postgres://"):
 app.config['SQLALCHEMY_DATABASE_URI'] = db_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Postgres (Render): gjenbruk tilkoblinger, test dem før bruk og bytt dem ut
+# før Render/Neon kutter inaktive tilkoblinger. SQLite lokalt trenger ikke dette.
+if db_url.startswith("postgresql"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 280,
+        'connect_args': {'application_name': 'ikt_ultaan'},
+    }
+
+# SQLite (lokalt): WAL lar flere gunicorn-workere/tråder lese mens én skriver,
+# og synchronous=NORMAL er trygt i WAL-modus men slipper fsync på hver commit.
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+# Jinja: del kompilerte templates mellom workere/omstarter, og fjern whitespace rundt {% %}-tagger.
+# (TEMPLATES_AUTO_RELOAD står urørt: den følger debug, og er dermed av i produksjon.)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+app.jinja_env.trim_blocks = True
+app.jinja_env.lstrip_blocks = True
+
 # Init extensions
-db = SQLAlchemy(app)
+# expire_on_commit=False: objekter beholder verdiene sine etter commit, så en flash-melding
+# eller redirect som leser user.username/loan.id ikke utløser en ny SELECT. Sesjonen
+# lever bare én forespørsel, så det er ingen fare for utdaterte data mellom forespørsler.
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
 csrf = CSRFProtect(app)
 
 
@@ -100,6 +148,17 @@ translations = {
         "Utlån oppdatert.": "Loan updated.",
         "PC slettet fra lager.": "PC deleted from inventory.",
         "Noe gikk galt ved sletting av PC.": "Something went wrong while deleting the PC.",
+        "Ingen PC-er valgt.": "No PCs selected.",
+        "Velg en CSV-fil å importere.": "Choose a CSV file to import.",
+        "Kunne ikke lese CSV-filen.": "Could not read the CSV file.",
+        "Noen av PC-ene finnes allerede. Ingenting ble importert.": "Some of the PCs already exist. Nothing was imported.",
+        "Importer fra CSV": "Import from CSV",
+        "Kolonner: OK-nummer, modell, notater. Første rad er overskrift.": "Columns: OK number, model, notes. The first row is a header.",
+        "Importer": "Import",
+        "Valgte PC-er slettet fra lager.": "Selected PCs deleted from inventory.",
+        "Slett valgte": "Delete selected",
+        "Velg alle": "Select all",
+        "Er du sikker på at du vil slette de valgte PC-ene?": "Are you sure you want to delete the selected PCs?",
 
         # Dashboard / oversikt
         "Utlån – oversikt": "Loans – overview",
@@ -119,6 +178,9 @@ translations = {
         "Returnerte utlån": "Returned loans",
         "Røde rader markerer forfalte aktive utlån": "Red rows indicate overdue active loans",
         "Eksporter Excel": "Export Excel",
+        "Vis flere": "Show more",
+        "Se hele historikken": "See full history",
+        "Utlånshistorikk": "Loan history",
 
 
         "Søk": "Search",
@@ -146,7 +208,6 @@ translations = {
         "Telefon": "Phone",
         "Utstyr": "Item",
         "PC": "PC",
-        "Utlånt": "Checked out",
         "Frist": "Due date",
         "Handlinger": "Actions",
 
@@ -180,7 +241,6 @@ translations = {
         "Valgfritt, men nyttig ved oppfølging.": "Optional, but useful for follow-up.",
 
         # New loan / PC search
-        "Nytt utlån": "New loan",
         "Navn på elev/ansatt *": "Name of student/employee *",
         "Klasse": "Class",
         "f.eks. 999 99 999": "e.g. 999 99 999",
@@ -188,7 +248,6 @@ translations = {
         "Velg PC (valgfritt)": "Select PC (optional)",
         "-- Ingen valgt --": "-- None selected --",
         "f.eks. Airpods, Bankkort, Id-kort...": "e.g. Airpods, Bank card, ID card...",
-        "Frist for innlevering": "Return deadline",
         "Avbryt": "Cancel",
         "Registrer utlån": "Register loan",
         "* Obligatoriske felt": "* Required fields",
@@ -243,7 +302,6 @@ translations = {
         "Legg til bruker": "Add user",
         "Brukeradministrasjon": "User administration",
         "ID": "ID",
-        "Handlinger": "Actions",
         "Ja": "Yes",
         "Nei": "No",
         "Fjern admin": "Remove admin",
@@ -255,6 +313,8 @@ translations = {
         # Profil
         "Brukernavn *": "Username *",
         "Nåværende passord *": "Current password *",
+        "Nåværende passord": "Current password",
+        "Du logget inn nylig, så nåværende passord trengs bare for å bytte passord.": "You logged in recently, so your current password is only needed to change your password.",
         "Du må oppgi ditt nåværende passord for å bekrefte endringer.": "You must enter your current password to confirm changes.",
         "Nytt passord": "New password",
         "La feltet stå tomt hvis du ikke vil endre passord.": "Leave this field empty if you do not want to change your password.",
@@ -285,6 +345,13 @@ translations = {
         "Klasser med flest utlån": "Classes with most loans",
         "Ingen utlån registrert ennå.": "No loans registered yet.",
         "Ingen klasser registrert på utlån ennå.": "No classes registered on loans yet.",
+        "Periode for topplistene": "Period for the top lists",
+        "Siste 30 dager": "Last 30 days",
+        "Siste 90 dager": "Last 90 days",
+        "Siste år": "Last year",
+        "Hele perioden": "All time",
+        "Ingen utlån i denne perioden.": "No loans in this period.",
+        "Ingen klasser registrert på utlån i denne perioden.": "No classes registered on loans in this period.",
 
         # Dynamic label value if ever needed
         "Ansatt": "Employee",
@@ -292,12 +359,12 @@ translations = {
 }
 
 
-def translate(text: str) -> str:
-    """Simple i18n function: uses Norwegian as default source text."""
-    lang = session.get("lang", "no")
-    if lang == "en":
-        return translations.get("en", {}).get(text, text)
-    return text
+# Frys oversettelsene ved import (ingen utilsiktet mutering) og intern nøklene
+translations = {
+    lang: MappingProxyType({sys.intern(key): value for key, value in table.items()})
+    for lang, table in translations.items()
+}
+_EN = translations["en"]
 
 
 # --------- DYNAMIC ITEM TRANSLATION (e.g. 'lader' -> 'Charger') ---------
@@ -320,19 +387,6 @@ item_translations_en = {
 }
 
 
-def translate_item(text: str) -> str:
-    """
-    Translate dynamic item names like 'lader' to English when lang=en.
-    If we don't know the word, just return it as-is.
-    """
-    if not text:
-        return text
-    lang = session.get("lang", "no")
-    if lang == "en":
-        return item_translations_en.get(text, text)
-    return text
-
-
 # --------- DYNAMIC CLASS TRANSLATION (e.g. 'Ansatt' -> 'Employee') ---------
 
 class_translations_en = {
@@ -343,28 +397,65 @@ class_translations_en = {
 }
 
 
-def translate_class(text: str) -> str:
-    """
-    Translate dynamic class info like 'Ansatt' when lang=en.
-    Real class names like '3IDA' will just pass through unchanged.
-    """
-    if not text:
-        return text
-    lang = session.get("lang", "no")
-    if lang == "en":
-        return class_translations_en.get(text, text)
+def _lookup(table):
+    """Translator bound to one dict; unknown (and empty) values pass through unchanged."""
+    def lookup(text):
+        return table.get(text, text)
+    return lookup
+
+
+def _identity(text):
     return text
 
 
+# (t, item_t, class_t) per språk – bygget én gang, så templates slipper språksjekk per streng
+TEMPLATE_TRANSLATORS = {
+    "no": (_identity, _identity, _identity),
+    "en": (_lookup(_EN), _lookup(item_translations_en), _lookup(class_translations_en)),
+}
+
+
 
 # -------------------- MODELS --------------------
 
+def utc_now():
+    """Tidssone-bevisst UTC-tid (erstatter datetime.utcnow(), som gir naiv tid)."""
+    return datetime.now(timezone.utc)
+
+
+class UTCDateTime(TypeDecorator):
+    """
+    Tidspunkt som lagres som naiv UTC (samme format som før, ingen migrering),
+    men alltid leses ut som tidssone-bevisst UTC.
+    """
+    impl = db.DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
+    # Brukernavnet med små bokstaver (Python str.lower()), så SQLite og Postgres folder likt
+    username_lower = db.Column(db.String(100))
     password_hash = db.Column(db.String(200), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
-    loans = db.relationship('Loan', backref='user', lazy=True)
+    # Samlinger lastes aldri implisitt (lazy='raise'); bruk egne spørringer
+    loans = db.relationship('Loan', back_populates='user', lazy='raise')
+
+    @validates('username')
+    def _fill_username_lower(self, key, value):
+        self.username_lower = value.lower()
+        return value
 
 
 class PC(db.Model):
@@ -375,11 +466,7 @@ class PC(db.Model):
     model_type = db.Column(db.String(100), nullable=False)
     notes = db.Column(db.String(200))
 
-    def active_loan(self):
-        return Loan.query.filter_by(pc_id=self.id, is_returned=False).first()
-
-    def is_loaned_out(self):
-        return self.active_loan() is not None
+    loans = db.relationship('Loan', back_populates='pc', lazy='raise')
 
 
 class Loan(db.Model):
@@ -391,32 +478,93 @@ class Loan(db.Model):
     class_info = db.Column(db.String(50))
     item = db.Column(db.String(100), nullable=False)
     reason = db.Column(db.String(200))
-    checkout_date = db.Column(db.DateTime, default=datetime.utcnow)
+    checkout_date = db.Column(UTCDateTime, default=utc_now)
     value = db.Column(db.String(100))
     due_date = db.Column(db.DateTime, nullable=True)
-    return_date = db.Column(db.DateTime, nullable=True)
+    return_date = db.Column(UTCDateTime, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_returned = db.Column(db.Boolean, default=False)
 
     pc_id = db.Column(db.Integer, db.ForeignKey('pc.id'), nullable=True)
-    pc = db.relationship('PC', backref='loans')
+
+    # Enkeltobjekter lastes ved behov; visningene velger selectin/joined/contains_eager selv
+    user = db.relationship('User', back_populates='loans', lazy='select')
+    pc = db.relationship('PC', back_populates='loans', lazy='select')
+
+    __table_args__ = (
+        # Dashboard-tellinger: aktive/forfalte
+        db.Index('ix_loan_active', 'is_returned', 'due_date'),
+        # Returnert i dag, og returnerte utlån (dashboard og historikk) sortert/paginert på (return_date, id)
+        db.Index('ix_loan_return_date', 'return_date'),
+        # Aktive utlån: filtrert på status, sortert på utlånt-dato
+        db.Index('ix_loan_returned_checkout', 'is_returned', 'checkout_date'),
+        # "Mine utlån", eierskapssjekk ved retur og sletting av brukere
+        db.Index('ix_loan_user', 'user_id'),
+    )
+
+    @validates('class_info')
+    def _empty_class_info_as_null(self, key, value):
+        # Tom gruppe lagres som NULL, så "har gruppe" er bare IS NOT NULL (delvis indeks ix_loan_class)
+        return value or None
+
+
+# Sortering av aktive utlån på dashboard (verdien fra <select> → ORDER BY).
+# Forutsetter at PC er outer-joinet i spørringen.
+ACTIVE_LOAN_SORTS = {
+    "checkout_desc": (Loan.checkout_date.desc(),),
+    "checkout_asc": (Loan.checkout_date.asc(),),
+    "due_asc": (Loan.due_date.is_(None), Loan.due_date.asc()),
+    "due_desc": (Loan.due_date.is_(None), Loan.due_date.desc()),
+    "item_asc": (func.lower(Loan.item).asc(),),
+    "item_desc": (func.lower(Loan.item).desc(),),
+    "pc_asc": (PC.ok_number.is_(None), PC.ok_number.asc()),
+    "pc_desc": (PC.ok_number.is_(None), PC.ok_number.desc()),
+    "name_asc": (func.lower(Loan.borrower_name).asc(),),
+    "name_desc": (func.lower(Loan.borrower_name).desc(),),
+}
+
+RETURNED_PAGE_SIZE = 50
+DASHBOARD_RETURNED_LIMIT = 25  # dashboard viser bare de siste; resten ligger i historikken
+
+# Maks ett aktivt utlån per PC – håndheves av databasen (delvis unik indeks)
+db.Index(
+    'ix_loan_active_pc', Loan.pc_id, unique=True,
+    postgresql_where=(Loan.is_returned == False),
+    sqlite_where=(Loan.is_returned == False),
+)
+
+# Statistikk: topplister og COUNT(DISTINCT) over utstyr og klasser leser indeksen, ikke tabellen
+db.Index('ix_loan_item', Loan.item)
+db.Index(
+    'ix_loan_class', Loan.class_info,
+    postgresql_where=Loan.class_info.isnot(None),
+    sqlite_where=Loan.class_info.isnot(None),
+)
+# Topplister for en periode: intervallsøk på utlånt-dato, utstyr og klasse leses fra indeksen
+db.Index('ix_loan_checkout', Loan.checkout_date, Loan.item, Loan.class_info)
+
+# Unikt brukernavn uten hensyn til store/små bokstaver ("Ola" og "ola", "Øyvind" og "øyvind"
+# er samme bruker). Indeksert på den lagrede kolonnen, ikke lower() i databasen: SQLite sin
+# lower() folder bare A–Z, mens Postgres folder Æ/Ø/Å også.
+db.Index('ix_user_username_norm', User.username_lower, unique=True)
+
+# Faste admin-setninger bygges én gang; SQLAlchemy gjenbruker da den kompilerte SQL-en
+# fra compiled_cache uten å bygge uttrykkstreet på nytt for hver forespørsel
+TOGGLE_ADMIN_STMT = (
+    update(User).where(User.id == bindparam('uid'))
+    .values(is_admin=~User.is_admin)
+    .returning(User.username, User.is_admin)
+)
+DELETE_LOAN_STMT = delete(Loan).where(Loan.id == bindparam('loan_id'))
 
 
 # -------------------- HELPERS --------------------
 
-def utc_to_local(utc_dt):
+def utc_to_local(utc_dt, _local_tz=OSLO_TZ):
     """Konverterer UTC-datetime til Europe/Oslo. Faller tilbake til UTC hvis tzdata mangler."""
-    if utc_dt is None:
-        return None
-
-    # If no tz DB, just return naive/UTC-ish time
-    if OSLO_TZ is None:
+    if utc_dt is None or _local_tz is None:
         return utc_dt
-
-    local_tz = OSLO_TZ
-    if utc_dt.tzinfo is None:
-        utc_dt = utc_dt.replace(tzinfo=UTC_TZ)
-    return utc_dt.astimezone(local_tz)
+    return utc_dt.astimezone(_local_tz)
 
 
 def local_today():
@@ -425,9 +573,281 @@ def local_today():
         return datetime.now().date()
     return datetime.now(OSLO_TZ).date()
 
+
+def local_day_start_utc(day):
+    """Start of a Europe/Oslo day in UTC, for comparing against stored UTC timestamps."""
+    start = datetime.combine(day, time.min)
+    if OSLO_TZ is None:
+        return start.replace(tzinfo=timezone.utc)
+    return start.replace(tzinfo=OSLO_TZ).astimezone(timezone.utc)
+
+def filter_loans(query, search, only_mine):
+    """Legg søk (navn, gruppe, utstyr, PC) og "bare mine" inn i WHERE. PC må være outer-joinet."""
+    if search:
+        query = query.filter(or_(
+            Loan.borrower_name.icontains(search, autoescape=True),
+            Loan.class_info.icontains(search, autoescape=True),
+            Loan.item.icontains(search, autoescape=True),
+            PC.ok_number.icontains(search, autoescape=True),
+            PC.model_type.icontains(search, autoescape=True),
+        ))
+    if only_mine:
+        query = query.filter(Loan.user_id == session.get('user_id'))
+    return query
+
+
+# PC-listen til nedtrekksmenyene endres sjelden, så den caches per prosess.
+# Tømmes når en PC lagres her; andre workere ser endringen senest etter TTL.
+PC_CACHE_TTL = 60  # sekunder
+PCChoice = namedtuple('PCChoice', 'id ok_number model_type')
+_pc_cache = {"rows": None, "loaded_at": 0.0}
+_pc_cache_lock = threading.Lock()
+
+
+def cached_pcs():
+    """Alle PC-er (id, OK-nummer, modell) sortert på OK-nummer, fra prosess-cachen."""
+    with _pc_cache_lock:
+        now = time_module.monotonic()
+        if _pc_cache["rows"] is None or now - _pc_cache["loaded_at"] > PC_CACHE_TTL:
+            rows = db.session.query(PC.id, PC.ok_number, PC.model_type).order_by(PC.ok_number.asc()).all()
+            _pc_cache["rows"] = [PCChoice(*row) for row in rows]
+            _pc_cache["loaded_at"] = now
+        return _pc_cache["rows"]
+
+
+def invalidate_pc_cache():
+    with _pc_cache_lock:
+        _pc_cache["rows"] = None
+
+
+# Statistikksiden: alle aggregatene regnes ut samlet og holdes i prosessen en kort stund.
+# Tømmes når denne prosessen endrer utlån; andre workere ser endringen innen STATS_CACHE_TTL.
+STATS_CACHE_TTL = 60  # sekunder
+# Periodevalg for topplistene (antall dager, 0 = hele perioden)
+STATS_PERIODS = (30, 90, 365, 0)
+STATS_DEFAULT_PERIOD = 90
+# periods: periode -> (loaded_at, data). generation økes ved hver tømming, så en utregning
+# som startet før en endring ikke legger gamle tall tilbake i cachen.
+_stats_cache = {"generation": 0, "periods": {}}
+_stats_cache_lock = threading.Lock()
+
+
+def cached_loan_stats(days=STATS_DEFAULT_PERIOD):
+    with _stats_cache_lock:
+        cached = _stats_cache["periods"].get(days)
+        if cached is not None and time_module.monotonic() - cached[0] <= STATS_CACHE_TTL:
+            return cached[1]
+        generation = _stats_cache["generation"]
+
+    # Regnes ut uten låsen, så andre /stats-forespørsler (også for andre perioder) ikke
+    # står og venter på spørringene. To samtidige bom kan regne ut det samme; det er ufarlig.
+    data = compute_loan_stats(days)
+
+    with _stats_cache_lock:
+        if _stats_cache["generation"] == generation:
+            _stats_cache["periods"][days] = (time_module.monotonic(), data)
+    return data
+
+
+def invalidate_stats_cache():
+    with _stats_cache_lock:
+        _stats_cache["generation"] += 1
+        _stats_cache["periods"].clear()
+
+
+# Cachene tømmes automatisk når en commit har endret PC- eller utlånsrader (ikke ved flush,
+# ellers kan en annen tråd laste inn på nytt før endringen er synlig)
+@event.listens_for(Session, 'after_flush')
+def _mark_cached_changes(session, flush_context):
+    changed = (*session.new, *session.dirty, *session.deleted)
+    if any(isinstance(obj, PC) for obj in changed):
+        session.info['pc_changed'] = True
+    if any(isinstance(obj, Loan) for obj in changed):
+        session.info['loan_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_caches_on_commit(session):
+    if session.info.pop('pc_changed', False):
+        invalidate_pc_cache()
+    if session.info.pop('loan_changed', False):
+        invalidate_stats_cache()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_cached_changes(session):
+    session.info.pop('pc_changed', None)
+    session.info.pop('loan_changed', None)
+
+
+# Passord: eksplisitte scrypt-parametre (N=2^15, r=8, p=1) gir forutsigbar tid per innlogging.
+# Kan justeres med PASSWORD_HASH_METHOD; hasher med andre parametre oppgraderes ved innlogging.
+# hashlib.scrypt slipper GIL-en mens den regner, så de andre gthread-trådene i workeren
+# betjener forespørsler imens – en egen trådpool for hashing ville ikke gitt noe ekstra.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def password_needs_rehash(password_hash):
+    return not password_hash.startswith(PASSWORD_HASH_METHOD + "$")
+
+
+# Rett etter innlogging slipper man å skrive passordet på nytt for profilendringer
+# (passordbytte krever det alltid). Sesjonen er signert, så auth_at kan ikke forfalskes.
+REAUTH_MAX_AGE = 15 * 60  # sekunder
+
+
+def recently_authenticated():
+    auth_at = session.get('auth_at')
+    return auth_at is not None and time_module.time() - auth_at < REAUTH_MAX_AGE
+
+
+def pc_choices():
+    """Cachede PC-er sammen med om de er utlånt nå (billig oppslag i ix_loan_active_pc)."""
+    loaned_ids = {
+        pc_id for (pc_id,) in db.session.query(Loan.pc_id).filter(
+            Loan.is_returned == False, Loan.pc_id.isnot(None)
+        )
+    }
+    return [(pc, pc.id in loaned_ids) for pc in cached_pcs()]
+
+
+def prepare_returned_loans(loans, now_utc):
+    """Legger på lokale tider, slette-nedtelling og PC-etikett for visning."""
+    for loan in loans:
+        loan.checkout_date_local = utc_to_local(loan.checkout_date)
+        loan.return_date_local = utc_to_local(loan.return_date)
+
+        loan.overdue = False  # returned loans are never overdue
+
+        # ✅ DELETE COUNTDOWN
+        loan.delete_in_days = None
+        if loan.return_date:
+            days_since_return = (now_utc - loan.return_date).days
+            retention_days = 5 * 365  # 5 years
+            loan.delete_in_days = max(0, retention_days - days_since_return)
+
+        # PC label
+        if loan.pc:
+            loan.pc_label = f"{loan.pc.ok_number} – {loan.pc.model_type}"
+            loan.pc_ok = loan.pc.ok_number
+            loan.pc_model = loan.pc.model_type
+        else:
+            loan.pc_label = ""
+            loan.pc_ok = ""
+            loan.pc_model = ""
+
+
+def month_range(first, last):
+    """Alle måneder fra og med first til og med last, som 'ÅÅÅÅ-MM'."""
+    year, month = int(first[:4]), int(first[5:7])
+    months = []
+    while f"{year:04d}-{month:02d}" <= last:
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def _fetch_rows(engine, stmt):
+    """Kjører en ren lese-spørring på egen tilkobling (trygt fra en annen tråd enn forespørselen)."""
+    with engine.connect() as conn:
+        return conn.execute(stmt).all()
+
+
+# Topplistene og månedsoversikten er uavhengige av hverandre og kjøres parallelt på Postgres.
+# SQLite serialiserer uansett lesingene i prosessen, så der kjøres de etter hverandre på sesjonen.
+_stats_executor = (
+    ThreadPoolExecutor(max_workers=3, thread_name_prefix='stats')
+    if db_url.startswith("postgresql") else None
+)
+
+
+def compute_loan_stats(days=STATS_DEFAULT_PERIOD):
+    """Alle tallene til statistikksiden (for alle utlån, ikke bare mine).
+
+    Topplistene tar bare med utlån fra de siste `days` dagene (0 = hele perioden).
+    """
+    today_start = datetime.combine(local_today(), time.min)
+
+    loan_count = func.count(Loan.id)
+    top_items_stmt = select(Loan.item, loan_count).group_by(Loan.item).order_by(
+        loan_count.desc(), Loan.item
+    ).limit(5)
+    top_classes_stmt = select(Loan.class_info, loan_count).where(
+        Loan.class_info.isnot(None)
+    ).group_by(Loan.class_info).order_by(loan_count.desc(), Loan.class_info).limit(5)
+    if days:
+        # De fleste vil se hva som er populært nå; et datointervall krymper grupperingen kraftig
+        since = utc_now() - timedelta(days=days)
+        top_items_stmt = top_items_stmt.where(Loan.checkout_date >= since)
+        top_classes_stmt = top_classes_stmt.where(Loan.checkout_date >= since)
+
+    # 'ÅÅÅÅ-MM' rett fra ISO-teksten: ett billig substr-uttrykk i stedet for to strftime-kall,
+    # og likt i SQLite (lagret som tekst) og Postgres (timestamp castet til tekst).
+    # Grupperes/sorteres på aliaset, så SQLite ser ett uttrykk og slipper en ekstra sortering.
+    month = func.substr(cast(Loan.checkout_date, db.String), 1, 7).label("month")
+    monthly_stmt = select(month, loan_count).where(
+        Loan.checkout_date.isnot(None)
+    ).group_by("month").order_by("month")
+
+    row_stmts = (top_items_stmt, top_classes_stmt, monthly_stmt)
+    futures = None
+    if _stats_executor is not None:
+        # Trådene bruker egne tilkoblinger fra poolen, ikke den forespørselsbundne sesjonen
+        engine = db.engine
+        futures = [_stats_executor.submit(_fetch_rows, engine, stmt) for stmt in row_stmts]
+
+    # Alle tellingene i én rad (betinget COUNT og COUNT DISTINCT) i stedet for én spørring per kort
+    (total_loans, active_count, returned_count, overdue_count,
+     distinct_borrowers, distinct_items) = db.session.query(
+        func.count(Loan.id),
+        func.count(case((Loan.is_returned == False, 1))),
+        func.count(case((Loan.is_returned == True, 1))),
+        func.count(case((and_(Loan.is_returned == False, Loan.due_date < today_start), 1))),
+        func.count(func.distinct(Loan.borrower_name)),
+        func.count(func.distinct(Loan.item)),
+    ).one()
+
+    if futures is not None:
+        top_items, top_classes, monthly_raw = (future.result() for future in futures)
+    else:
+        top_items, top_classes, monthly_raw = (db.session.execute(stmt).all() for stmt in row_stmts)
+
+    # Måneder uten utlån fylles inn med 0 i Python, så tidslinja blir sammenhengende
+    counts = dict(monthly_raw)
+    monthly_stats = []
+    if counts:
+        last_month = max(max(counts), local_today().strftime('%Y-%m'))
+        monthly_stats = [
+            {"month": m, "count": counts.get(m, 0)} for m in month_range(min(counts), last_month)
+        ]
+
+    result = {
+        "days": days,
+        "total_loans": total_loans,
+        "active_count": active_count,
+        "returned_count": returned_count,
+        "overdue_count": overdue_count,
+        "distinct_borrowers": distinct_borrowers,
+        "distinct_items": distinct_items,
+        "top_items": [(item, n) for item, n in top_items],
+        "top_classes": [(class_info, n) for class_info, n in top_classes],
+        "monthly_stats": monthly_stats,
+        "monthly_max": max((row["count"] for row in monthly_stats), default=0),
+    }
+    # Fingeravtrykk av tallene til ETag på /stats – regnes ut én gang per cache-periode
+    result["stats_digest"] = hashlib.blake2b(
+        json.dumps(result, default=str, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+    return result
+
+
 def cleanup_old_returned_loans():
     """Delete returned loans older than 5 years"""
-    cutoff = datetime.utcnow() - timedelta(days=5*365)
+    cutoff = utc_now() - timedelta(days=5*365)
 
     old_loans = Loan.query.filter(
         Loan.is_returned == True,
@@ -462,15 +882,33 @@ def admin_required(f):
     return wrap
 
 
+def no_autoflush(f):
+    """For lesevisninger: spørringer trenger ikke flushe sesjonen først (commit flusher fortsatt)."""
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        with db.session.no_autoflush:
+            return f(*args, **kwargs)
+    return wrap
+
+
+@app.before_request
+def load_language():
+    """Les språkvalget fra session én gang per request."""
+    g.lang = session.get("lang", "no")
+
+
 # Gjør is_admin, t, item_t, class_t og current_lang tilgjengelig i alle templates
 @app.context_processor
 def inject_admin_flag():
+    # Maler kan rendres utenfor en forespørsel som har vært innom before_request (uten g.lang)
+    lang = g.get("lang", "no")
+    t, item_t, class_t = TEMPLATE_TRANSLATORS.get(lang, TEMPLATE_TRANSLATORS["no"])
     return {
         "is_admin": session.get("is_admin", False),
-        "t": translate,
-        "item_t": translate_item,
-        "class_t": translate_class,  # 👈 use this in templates for loan.class_info
-        "current_lang": session.get("lang", "no"),
+        "t": t,
+        "item_t": item_t,
+        "class_t": class_t,  # 👈 use this in templates for loan.class_info
+        "current_lang": lang,
     }
 
 
@@ -479,11 +917,48 @@ def inject_admin_flag():
 with app.app_context():
     db.create_all()
 
+    # create_all legger ikke til nye kolonner i tabeller som finnes fra før
+    if 'username_lower' not in {col['name'] for col in inspect(db.engine).get_columns(User.__tablename__)}:
+        preparer = db.engine.dialect.identifier_preparer
+        column = User.__table__.c.username_lower
+        with db.engine.begin() as conn:
+            conn.execute(text(
+                f"ALTER TABLE {preparer.format_table(User.__table__)} "
+                f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=db.engine.dialect)}"
+            ))
+    # Fyll inn username_lower for eldre brukere (før den unike indeksen opprettes)
+    legacy_users = db.session.execute(
+        select(User.id, User.username).where(User.username_lower.is_(None))
+    ).all()
+    if legacy_users:
+        db.session.execute(
+            update(User),
+            [{"id": user_id, "username_lower": username.lower()} for user_id, username in legacy_users]
+        )
+        db.session.commit()
+    # Erstattet av ix_user_username_norm (lower() i databasen folder ulikt i SQLite og Postgres)
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_user_username_lower"))
+
+    # create_all lager ikke nye indekser på tabeller som finnes fra før
+    # (IF NOT EXISTS i stedet for checkfirst: refleksjon ser ikke uttrykksindekser som lower(username))
+    for index in (*Loan.__table__.indexes, *User.__table__.indexes):
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        except Exception as e:
+            # f.eks. unik indeks når gamle data allerede har duplikater
+            print(f"⚠️ Kunne ikke opprette indeks {index.name}: {e}")
+
+    # Eldre rader kan ha tom streng som gruppe; nye lagres som NULL (se Loan._empty_class_info_as_null)
+    db.session.execute(update(Loan).where(Loan.class_info == "").values(class_info=None))
+    db.session.commit()
+
     # Auto-opprett første admin hvis databasen er tom
     if User.query.count() == 0:
         default_admin = User(
             username="admin",
-            password_hash=generate_password_hash("admin123"),
+            password_hash=hash_password("admin123"),
             is_admin=True
         )
         db.session.add(default_admin)
@@ -491,6 +966,14 @@ with app.app_context():
         print("✅ Opprettet standard admin: admin / admin123")
 
 
+# -------------------- TEMPLATES --------------------
+
+# Kompiler alle malene når workeren starter, så første forespørsel mot hver side
+# slipper å parse og kompilere malen (og base.html) mens brukeren venter
+for template_name in app.jinja_env.list_templates(extensions=['html']):
+    app.jinja_env.get_template(template_name)
+
+
 # -------------------- LANGUAGE ROUTE --------------------
 
 @app.route('/lang/<lang_code>')
@@ -519,12 +1002,19 @@ def login():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
 
-        user = User.query.filter_by(username=username).first()
+        # Brukernavn skilles ikke på store/små bokstaver (slår opp via ix_user_username_norm)
+        user = User.query.filter_by(username_lower=username.lower()).first()
 
         if user and check_password_hash(user.password_hash, password):
+            # Eldre hash (f.eks. pbkdf2 eller andre scrypt-parametre): lagre på nytt med gjeldende metode
+            if password_needs_rehash(user.password_hash):
+                user.password_hash = hash_password(password)
+                db.session.commit()
+
             session['user_id'] = user.id
             session['username'] = user.username
             session['is_admin'] = user.is_admin
+            session['auth_at'] = int(time_module.time())
             flash('Innlogging vellykket.', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -545,14 +1035,43 @@ def logout():
 
 @app.route('/dashboard')
 @login_required
+@no_autoflush
 def dashboard():
     cleanup_old_returned_loans()
 
-    active_loans = Loan.query.filter_by(is_returned=False).all()
-    returned_loans = Loan.query.filter_by(is_returned=True).all()
+    search = request.args.get('q', '').strip()
+    only_mine = request.args.get('mine') == '1'
+    only_overdue = request.args.get('overdue') == '1'
+    sort = request.args.get('sort', 'checkout_desc')
+    if sort not in ACTIVE_LOAN_SORTS:
+        sort = 'checkout_desc'
 
     today_local = local_today()
-    now_utc = datetime.utcnow()
+    now_utc = utc_now()
+    today_start = datetime.combine(today_local, time.min)
+
+    # PC hentes i samme spørring (outer join), så vi kan søke og sortere på den
+    base_query = Loan.query.outerjoin(Loan.pc).options(contains_eager(Loan.pc))
+
+    active_query = filter_loans(base_query.filter(Loan.is_returned == False), search, only_mine)
+    if only_overdue:
+        active_query = active_query.filter(Loan.due_date < today_start)
+    # Forfalt-flagget regnes ut i samme SELECT (CASE) i stedet for per rad i Python
+    overdue_flag = case((Loan.due_date < today_start, True), else_=False).label('overdue')
+    active_rows = active_query.add_columns(overdue_flag).order_by(
+        *ACTIVE_LOAN_SORTS[sort], Loan.id.desc()
+    ).all()
+    active_loans = []
+    for loan, overdue in active_rows:
+        loan.overdue = overdue
+        active_loans.append(loan)
+
+    # Returnerte: bare de siste her, full historikk på /loans/history
+    returned_loans = filter_loans(
+        base_query.filter(Loan.is_returned == True), search, only_mine
+    ).order_by(
+        Loan.return_date.desc(), Loan.id.desc()
+    ).limit(DASHBOARD_RETURNED_LIMIT).all()
 
     # --------------------
     # ACTIVE LOANS
@@ -561,12 +1080,6 @@ def dashboard():
         loan.checkout_date_local = utc_to_local(loan.checkout_date)
         loan.return_date_local = None
 
-        # ✅ OVERDUE FLAG
-        loan.overdue = (
-            loan.due_date is not None
-            and loan.due_date.date() < today_local
-        )
-
         # PC label
         if loan.pc:
             loan.pc_label = f"{loan.pc.ok_number} – {loan.pc.model_type}"
@@ -580,42 +1093,28 @@ def dashboard():
     # --------------------
     # RETURNED LOANS
     # --------------------
-    for loan in returned_loans:
-        loan.checkout_date_local = utc_to_local(loan.checkout_date)
-        loan.return_date_local = utc_to_local(loan.return_date)
-
-        loan.overdue = False  # returned loans are never overdue
-
-        # ✅ DELETE COUNTDOWN
-        loan.delete_in_days = None
-        if loan.return_date:
-            days_since_return = (now_utc - loan.return_date).days
-            retention_days = 5 * 365  # 5 years
-            loan.delete_in_days = max(0, retention_days - days_since_return)
-
-        # PC label
-        if loan.pc:
-            loan.pc_label = f"{loan.pc.ok_number} – {loan.pc.model_type}"
-            loan.pc_ok = loan.pc.ok_number
-            loan.pc_model = loan.pc.model_type
-        else:
-            loan.pc_label = ""
-            loan.pc_ok = ""
-            loan.pc_model = ""
+    prepare_returned_loans(returned_loans, now_utc)
 
     # --------------------
-    # STATS
+    # STATS (tellinger i databasen, ikke i Python)
     # --------------------
-    overdue_count = sum(1 for l in active_loans if l.overdue)
+    total_active = db.session.query(func.count(Loan.id)).filter(
+        Loan.is_returned == False
+    ).scalar()
 
-    returned_today_count = sum(
-        1 for l in returned_loans
-        if l.return_date_local
-        and l.return_date_local.date() == today_local
-    )
+    overdue_count = db.session.query(func.count(Loan.id)).filter(
+        Loan.is_returned == False,
+        Loan.due_date < today_start
+    ).scalar()
+
+    returned_today_count = db.session.query(func.count(Loan.id)).filter(
+        Loan.is_returned == True,
+        Loan.return_date >= local_day_start_utc(today_local)
+    ).scalar()
 
-    total_active = len(active_loans)
-    total_returned = len(returned_loans)
+    total_returned = db.session.query(func.count(Loan.id)).filter(
+        Loan.is_returned == True
+    ).scalar()
 
     return render_template(
         'dashboard.html',
@@ -624,7 +1123,59 @@ def dashboard():
         total_active=total_active,
         overdue_count=overdue_count,
         returned_today_count=returned_today_count,
-        total_returned=total_returned
+        total_returned=total_returned,
+        search=search,
+        only_mine=only_mine,
+        only_overdue=only_overdue,
+        sort=sort
+    )
+
+
+@app.route('/loans/history')
+@login_required
+@no_autoflush
+def loan_history():
+    search = request.args.get('q', '').strip()
+    only_mine = request.args.get('mine') == '1'
+
+    returned_query = filter_loans(
+        Loan.query.outerjoin(Loan.pc).options(contains_eager(Loan.pc)).filter(Loan.is_returned == True),
+        search, only_mine
+    )
+    total_count = returned_query.order_by(None).count()
+
+    # Keyset-paginering på (return_date, id) i stedet for OFFSET – samme rekkefølge som på dashboardet
+    before_id = request.args.get('before_id', type=int)
+    before = request.args.get('before', '')
+    if before_id and before:
+        try:
+            before_dt = datetime.fromisoformat(before)
+        except ValueError:
+            before_dt = None
+        if before_dt:
+            returned_query = returned_query.filter(or_(
+                Loan.return_date < before_dt,
+                and_(Loan.return_date == before_dt, Loan.id < before_id)
+            ))
+    returned_loans = returned_query.order_by(
+        Loan.return_date.desc(), Loan.id.desc()
+    ).limit(RETURNED_PAGE_SIZE + 1).all()
+
+    next_cursor = None
+    if len(returned_loans) > RETURNED_PAGE_SIZE:
+        returned_loans = returned_loans[:RETURNED_PAGE_SIZE]
+        last = returned_loans[-1]
+        next_cursor = {"before": last.return_date.isoformat(), "before_id": last.id}
+
+    prepare_returned_loans(returned_loans, utc_now())
+
+    return render_template(
+        'loan_history.html',
+        returned_loans=returned_loans,
+        total_count=total_count,
+        search=search,
+        only_mine=only_mine,
+        next_cursor=next_cursor
     )
 
 
@@ -632,8 +1183,6 @@ def dashboard():
 @app.route('/loan/new', methods=['GET', 'POST'])
 @login_required
 def new_loan():
-    pcs = PC.query.order_by(PC.ok_number.asc()).all()
-
     if request.method == 'POST':
         borrower_name = request.form.get('borrower_name', '').strip()
         borrower_phone = request.form.get('borrower_phone', '').strip()
@@ -660,12 +1209,12 @@ def new_loan():
             except ValueError:
                 flash('Ugyldig frist-dato. Bruk format ÅÅÅÅ-MM-DD.', 'danger')
                 # Vis samme skjema igjen med dataen bevart
-                return render_template('new_loan.html', pcs=pcs, form=request.form)
+                return render_template('new_loan.html', pcs=pc_choices(), form=request.form)
 
         # --- Valider påkrevde felt ---
         if not borrower_name or not item:
             flash('Navn og utstyr er påkrevd.', 'danger')
-            return render_template('new_loan.html', pcs=pcs, form=request.form)
+            return render_template('new_loan.html', pcs=pc_choices(), form=request.form)
 
         # --- Finn / lag PC ---
         selected_pc_id = None
@@ -698,15 +1247,7 @@ def new_loan():
                 "danger"
             )
             db.session.rollback()
-            return render_template('new_loan.html', pcs=pcs, form=request.form)
-
-        # 3) Blokker lån hvis valgt PC allerede er utlånt
-        if selected_pc_id:
-            already_out = Loan.query.filter_by(pc_id=selected_pc_id, is_returned=False).first()
-            if already_out:
-                flash("Denne PC-en er allerede utlånt.", "danger")
-                db.session.rollback()
-                return render_template('new_loan.html', pcs=pcs, form=request.form)
+            return render_template('new_loan.html', pcs=pc_choices(), form=request.form)
 
         # --- Lag selve utlånet ---
         loan = Loan(
@@ -722,20 +1263,28 @@ def new_loan():
         )
 
         db.session.add(loan)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 3) ix_loan_active_pc: valgt PC er allerede utlånt (atomisk, ingen ekstra SELECT)
+            db.session.rollback()
+            flash("Denne PC-en er allerede utlånt.", "danger")
+            return render_template('new_loan.html', pcs=pc_choices(), form=request.form)
 
         flash('Utlån registrert.', 'success')
         return redirect(url_for('dashboard'))
 
     # GET: tomt skjema → form = {}
-    return render_template('new_loan.html', pcs=pcs, form={})
+    return render_template('new_loan.html', pcs=pc_choices(), form={})
 
 
 
 @app.route('/loan/<int:loan_id>')
 @login_required
+@no_autoflush
 def loan_detail(loan_id):
-    loan = Loan.query.get_or_404(loan_id)
+    # PC og "Registrert av" hentes i samme spørring
+    loan = Loan.query.options(joinedload(Loan.pc), joinedload(Loan.user)).get_or_404(loan_id)
 
     loan.checkout_date_local = utc_to_local(loan.checkout_date)
     loan.return_date_local = utc_to_local(loan.return_date)
@@ -758,23 +1307,27 @@ def loan_detail(loan_id):
 @app.route('/loan/<int:loan_id>/return', methods=['POST'])
 @login_required
 def return_loan(loan_id):
-    loan = Loan.query.get_or_404(loan_id)
-
     is_admin = session.get('is_admin', False)
-    is_owner = loan.user_id == session.get('user_id')
 
-    if not is_admin and not is_owner:
-        flash('Du har ikke tilgang til å returnere dette utlånet.', 'danger')
-        return redirect(url_for('dashboard'))
+    # Ett atomisk UPDATE i stedet for SELECT + endring: to samtidige returer kan ikke begge "vinne"
+    stmt = update(Loan).where(Loan.id == loan_id, Loan.is_returned == False)
+    if not is_admin:
+        stmt = stmt.where(Loan.user_id == session.get('user_id'))
+    result = db.session.execute(stmt.values(is_returned=True, return_date=utc_now()))
+    db.session.commit()
+    invalidate_stats_cache()  # Core-UPDATE går utenom ORM-flush-hendelsene
+
+    if result.rowcount == 0:
+        # Ingen rad oppdatert: finnes ikke, mangler tilgang eller er allerede returnert
+        loan = Loan.query.get_or_404(loan_id)
+
+        if not is_admin and loan.user_id != session.get('user_id'):
+            flash('Du har ikke tilgang til å returnere dette utlånet.', 'danger')
+            return redirect(url_for('dashboard'))
 
-    if loan.is_returned:
         flash('Dette utlånet er allerede markert som returnert.', 'info')
         return redirect(url_for('loan_detail', loan_id=loan_id))
 
-    loan.is_returned = True
-    loan.return_date = datetime.utcnow()
-    db.session.commit()
-
     flash('Utlånet er markert som returnert.', 'success')
     return redirect(url_for('loan_detail', loan_id=loan_id))
 
@@ -783,9 +1336,12 @@ def return_loan(loan_id):
 @login_required
 @admin_required
 def delete_loan(loan_id):
-    loan = Loan.query.get_or_404(loan_id)
-    db.session.delete(loan)
+    # DELETE direkte på primærnøkkelen, uten SELECT først
+    result = db.session.execute(DELETE_LOAN_STMT, {'loan_id': loan_id})
+    if result.rowcount == 0:
+        abort(404)
     db.session.commit()
+    invalidate_stats_cache()
 
     flash('Utlånet ble slettet.', 'success')
     return redirect(url_for('dashboard'))
@@ -795,7 +1351,6 @@ def delete_loan(loan_id):
 @login_required
 def edit_loan(loan_id):
     loan = Loan.query.get_or_404(loan_id)
-    pcs = PC.query.order_by(PC.ok_number.asc()).all()
 
     is_admin = session.get('is_admin', False)
     is_owner = loan.user_id == session.get('user_id')
@@ -829,13 +1384,6 @@ def edit_loan(loan_id):
 
         selected_pc_id = int(pc_id) if pc_id else None
 
-        # If changing PC, block if that PC is already out on another active loan
-        if selected_pc_id and selected_pc_id != loan.pc_id:
-            already_out = Loan.query.filter_by(pc_id=selected_pc_id, is_returned=False).first()
-            if already_out:
-                flash("Denne PC-en er allerede utlånt.", "danger")
-                return redirect(url_for('edit_loan', loan_id=loan.id))
-
         # Update loan fields
         loan.borrower_name = borrower_name
         loan.borrower_phone = borrower_phone
@@ -846,14 +1394,21 @@ def edit_loan(loan_id):
         loan.due_date = due_date
         loan.pc_id = selected_pc_id
 
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # ix_loan_active_pc: PC-en er allerede ute på et annet aktivt utlån
+            db.session.rollback()
+            flash("Denne PC-en er allerede utlånt.", "danger")
+            return redirect(url_for('edit_loan', loan_id=loan_id))
+
         flash("Utlån oppdatert.", "success")
         return redirect(url_for('loan_detail', loan_id=loan.id))
 
     return render_template(
         'loan_edit.html',
         loan=loan,
-        pcs=pcs,
+        pcs=cached_pcs(),
         is_admin=is_admin,
         is_owner=is_owner
     )
@@ -863,8 +1418,17 @@ def edit_loan(loan_id):
 
 @app.route('/pcs')
 @login_required
+@no_autoflush
 def pc_inventory():
-    pcs = PC.query.order_by(PC.ok_number.asc()).all()
+    # Én spørring: hver PC sammen med sitt aktive utlån, bare kolonnene tabellen viser
+    pcs = db.session.query(
+        PC.id, PC.ok_number, PC.model_type,
+        # Utlånskolonnene får egne navn, så de ikke kan forveksles med PC-kolonner i raden
+        Loan.id.label('loan_id'), Loan.borrower_name.label('loan_borrower_name'),
+        Loan.class_info.label('loan_class_info'), Loan.due_date.label('loan_due_date')
+    ).outerjoin(
+        Loan, and_(Loan.pc_id == PC.id, Loan.is_returned == False)
+    ).order_by(PC.ok_number.asc()).all()
     return render_template('pc_inventory.html', pcs=pcs)
 
 
@@ -882,14 +1446,15 @@ def add_pc():
             flash("OK-nummer og modelltype er påkrevd.", "danger")
             return redirect(url_for('add_pc'))
 
-        existing = PC.query.filter_by(ok_number=ok_number).first()
-        if existing:
-            flash("Denne PC-en finnes allerede.", "danger")
-            return redirect(url_for('add_pc'))
-
         pc = PC(ok_number=ok_number, model_type=model_type, notes=notes or None)
         db.session.add(pc)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # unik ok_number: duplikat fanges av databasen, ingen ekstra SELECT
+            db.session.rollback()
+            flash("Denne PC-en finnes allerede.", "danger")
+            return redirect(url_for('add_pc'))
 
         flash("PC lagt til i oversikten.", "success")
         return redirect(url_for('pc_inventory'))
@@ -912,17 +1477,17 @@ def edit_pc(pc_id):
             flash("OK-nummer og modelltype er påkrevd.", "danger")
             return redirect(url_for('edit_pc', pc_id=pc.id))
 
-        # prevent OK-number collision with another PC
-        existing = PC.query.filter(PC.ok_number == ok_number, PC.id != pc.id).first()
-        if existing:
-            flash("Denne PC-en finnes allerede.", "danger")
-            return redirect(url_for('edit_pc', pc_id=pc.id))
-
         pc.ok_number = ok_number
         pc.model_type = model_type
         pc.notes = notes
 
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # OK-nummeret tilhører allerede en annen PC (unik ok_number)
+            db.session.rollback()
+            flash("Denne PC-en finnes allerede.", "danger")
+            return redirect(url_for('edit_pc', pc_id=pc_id))
         flash("PC oppdatert.", "success")
         return redirect(url_for('pc_inventory'))
 
@@ -946,13 +1511,87 @@ def delete_pc(pc_id):
     return redirect(url_for('pc_inventory'))
 
 
+@app.route('/pcs/import', methods=['POST'])
+@login_required
+@admin_required
+def import_pcs():
+    """CSV med kolonnene OK-nummer, modell, notater (første rad er overskrift)."""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash("Velg en CSV-fil å importere.", "danger")
+        return redirect(url_for('add_pc'))
+
+    try:
+        text = upload.read().decode('utf-8-sig')
+        # Excel på norsk lagrer CSV med semikolon
+        dialect = csv.Sniffer().sniff(text.split('\n', 1)[0], delimiters=';,')
+        reader = csv.reader(io.StringIO(text), dialect)
+        next(reader, None)
+    except (UnicodeDecodeError, csv.Error):
+        flash("Kunne ikke lese CSV-filen.", "danger")
+        return redirect(url_for('add_pc'))
+
+    existing = {ok for (ok,) in db.session.query(PC.ok_number)}
+    rows = []
+    skipped = 0
+    for record in reader:
+        ok_number = record[0].strip() if len(record) > 0 else ''
+        model_type = record[1].strip() if len(record) > 1 else ''
+        notes = record[2].strip() if len(record) > 2 else ''
+        if not ok_number or not model_type or ok_number in existing:
+            skipped += 1
+            continue
+        existing.add(ok_number)
+        rows.append({"ok_number": ok_number, "model_type": model_type, "notes": notes or None})
+
+    if rows:
+        # Én INSERT med mange rader (executemany) og én commit, uten ORM-objekter per rad
+        try:
+            db.session.execute(insert(PC), rows)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash("Noen av PC-ene finnes allerede. Ingenting ble importert.", "danger")
+            return redirect(url_for('add_pc'))
+        invalidate_pc_cache()  # Core-setninger går utenom ORM-flush-hendelsene
+
+    flash(f"{len(rows)} PC-er importert, {skipped} hoppet over.", "success")
+    return redirect(url_for('pc_inventory'))
+
+
+@app.route('/pcs/delete_bulk', methods=['POST'])
+@login_required
+@admin_required
+def delete_pcs_bulk():
+    pc_ids = [int(i) for i in request.form.getlist('ids') if i.isdigit()]
+    if not pc_ids:
+        flash("Ingen PC-er valgt.", "info")
+        return redirect(url_for('pc_inventory'))
+
+    # To setninger og én commit for hele utvalget, i stedet for SELECT + DELETE + COMMIT per PC.
+    # Utlån som pekte på PC-ene beholdes uten PC, slik ORM-slettingen i delete_pc gjør.
+    try:
+        db.session.execute(update(Loan).where(Loan.pc_id.in_(pc_ids)).values(pc_id=None))
+        db.session.execute(delete(PC).where(PC.id.in_(pc_ids)))
+        db.session.commit()
+        invalidate_pc_cache()  # Core-setninger går utenom ORM-flush-hendelsene
+        flash("Valgte PC-er slettet fra lager.", "success")
+    except Exception:
+        db.session.rollback()
+        flash("Noe gikk galt ved sletting av PC.", "danger")
+
+    return redirect(url_for('pc_inventory'))
+
+
 # -------------------- ADMIN USERS --------------------
 
 @app.route('/admin')
 @login_required
 @admin_required
+@no_autoflush
 def admin_panel():
-    users = User.query.order_by(User.id.asc()).all()
+    # Bare kolonnene tabellen trenger (ikke passord-hashen)
+    users = db.session.query(User.id, User.username, User.is_admin).order_by(User.id.asc()).all()
     return render_template('admin_panel.html', users=users)
 
 
@@ -969,16 +1608,17 @@ def add_user():
             flash('Brukernavn og passord er påkrevd.', 'danger')
             return redirect(url_for('add_user'))
 
-        existing_user = User.query.filter_by(username=username).first()
-        if existing_user:
-            flash('Brukernavnet er allerede i bruk.', 'danger')
-            return redirect(url_for('add_user'))
-
-        hashed_password = generate_password_hash(password)
+        hashed_password = hash_password(password)
         new_user = User(username=username, password_hash=hashed_password, is_admin=is_admin_flag)
 
         db.session.add(new_user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # unikt brukernavn (også uten hensyn til store/små bokstaver) håndheves av databasen
+            db.session.rollback()
+            flash('Brukernavnet er allerede i bruk.', 'danger')
+            return redirect(url_for('add_user'))
 
         flash('Bruker lagt til.', 'success')
         return redirect(url_for('admin_panel'))
@@ -990,17 +1630,18 @@ def add_user():
 @login_required
 @admin_required
 def toggle_admin(user_id):
-    user = User.query.get_or_404(user_id)
-
-    if user.id == session.get('user_id'):
+    if user_id == session.get('user_id'):
         flash("Du kan ikke fjerne admin-rettigheter fra din egen bruker.", "danger")
         return redirect(url_for('admin_panel'))
 
-    user.is_admin = not user.is_admin
+    # Ett UPDATE ... RETURNING: snur flagget i databasen uten å laste brukeren først
+    row = db.session.execute(TOGGLE_ADMIN_STMT, {'uid': user_id}).first()
+    if row is None:
+        abort(404)
     db.session.commit()
 
-    status = "nå administrator" if user.is_admin else "ikke lenger administrator"
-    flash(f"{user.username} er {status}.", "success")
+    status = "nå administrator" if row.is_admin else "ikke lenger administrator"
+    flash(f"{row.username} er {status}.", "success")
     return redirect(url_for('admin_panel'))
 
 
@@ -1014,7 +1655,9 @@ def delete_user(user_id):
         flash("Du kan ikke slette din egen bruker.", "danger")
         return redirect(url_for('admin_panel'))
 
-    if user.loans and len(user.loans) > 0:
+    # EXISTS-sjekk: ingen utlånsrader hentes eller lastes inn i ORM-en
+    has_loans = db.session.query(Loan.query.filter_by(user_id=user.id).exists()).scalar()
+    if has_loans:
         flash("Kan ikke slette bruker som har registrerte utlån.", "danger")
         return redirect(url_for('admin_panel'))
 
@@ -1031,6 +1674,7 @@ def delete_user(user_id):
 @login_required
 def profile():
     user = User.query.get_or_404(session['user_id'])
+    password_required = not recently_authenticated()
 
     if request.method == 'POST':
         new_username = request.form.get('username', '').strip()
@@ -1038,28 +1682,32 @@ def profile():
         new_password = request.form.get('new_password', '')
         confirm_password = request.form.get('confirm_password', '')
 
-        if not check_password_hash(user.password_hash, current_password):
+        # Passord-hashen sjekkes bare når den trengs (nytt passord eller gammel innlogging)
+        if (password_required or new_password) and not check_password_hash(user.password_hash, current_password):
             flash("Nåværende passord er feil.", "danger")
             return redirect(url_for('profile'))
 
+        if new_password and new_password != confirm_password:
+            flash("Nytt passord og bekreftelse matcher ikke.", "danger")
+            return redirect(url_for('profile'))
+
         if new_username and new_username != user.username:
-            if User.query.filter_by(username=new_username).first():
-                flash("Brukernavnet er allerede i bruk.", "danger")
-                return redirect(url_for('profile'))
             user.username = new_username
-            session['username'] = new_username
-
         if new_password:
-            if new_password != confirm_password:
-                flash("Nytt passord og bekreftelse matcher ikke.", "danger")
-                return redirect(url_for('profile'))
-            user.password_hash = generate_password_hash(new_password)
+            user.password_hash = hash_password(new_password)
 
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # ix_user_username_norm: navnet er tatt (uavhengig av store/små bokstaver)
+            db.session.rollback()
+            flash("Brukernavnet er allerede i bruk.", "danger")
+            return redirect(url_for('profile'))
+        session['username'] = user.username
         flash("Profil oppdatert.", "success")
         return redirect(url_for('profile'))
 
-    return render_template('user_profile.html', user=user)
+    return render_template('user_profile.html', user=user, password_required=password_required)
 
 
 @app.route('/loans/export/excel')
@@ -1100,14 +1748,49 @@ def export_loans_excel():
 
 
 
+# -------------------- STATISTIKK --------------------
+
+@app.route('/stats')
+@login_required
+@admin_required  # tallene dekker alle brukeres utlån, som de andre admin-visningene
+@no_autoflush
+def stats():
+    days = request.args.get('days', STATS_DEFAULT_PERIOD, type=int)
+    if days not in STATS_PERIODS:
+        days = STATS_DEFAULT_PERIOD
+    data = cached_loan_stats(days)
+
+    # Siden viser også språk og innlogget bruker, så de må inn i ETag-en sammen med tallene
+    etag = hashlib.blake2b(
+        f"{data['stats_digest']}:{days}:{g.lang}:{session.get('user_id')}:{session.get('username')}:{session.get('is_admin')}".encode(),
+        digest_size=16,
+    ).hexdigest()
+
+    # Ventende flash-meldinger må rendres, ellers forsvinner de bak en 304
+    if not session.get('_flashes') and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template('stats.html', **data))
+
+    # no-cache: nettleseren må alltid spørre serveren (innlogging, språkbytte og ferske tall),
+    # men kan gjenbruke siden den har når svaret er 304
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 # -------------------- MAIN --------------------
 
 if __name__ == '__main__':
+    # Kun lokal utvikling – i produksjon kjøres appen av gunicorn (se Procfile).
+    # Debugger/reloader må slås på eksplisitt med FLASK_DEBUG=1.
+    dev_mode = os.getenv("FLASK_DEBUG") == "1"
     app.run(
-        debug=True,
-        port=5000,
+        debug=dev_mode,
+        port=int(os.getenv("PORT", 5000)),
         host='0.0.0.0',
         threaded=True,
-        use_reloader=True,
-        use_debugger=True
+        use_reloader=dev_mode,
+        use_debugger=dev_mode
     )
@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy.exc import IntegrityError
+
+# Egen SQLite-fil for testene – må settes før app importeres
+_db_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_db_dir, "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as loan_app  # noqa: E402
+
+
+class LoginUsernameCaseTest(unittest.TestCase):
+    """Innlogging slår opp brukernavn uten hensyn til store/små bokstaver, også Æ/Ø/Å."""
+
+    @classmethod
+    def setUpClass(cls):
+        loan_app.app.config["TESTING"] = True
+        loan_app.app.config["WTF_CSRF_ENABLED"] = False
+        with loan_app.app.app_context():
+            for username in ("Åse", "Øyvind", "Kari"):
+                loan_app.db.session.add(loan_app.User(
+                    username=username, password_hash=loan_app.hash_password("pw-" + username)
+                ))
+            loan_app.db.session.commit()
+
+    def login(self, username, password):
+        client = loan_app.app.test_client()
+        client.post("/", data={"username": username, "password": password})
+        with client.session_transaction() as sess:
+            return sess.get("username")
+
+    def test_non_ascii_username_logs_in_with_exact_name(self):
+        self.assertEqual(self.login("Åse", "pw-Åse"), "Åse")
+
+    def test_non_ascii_username_is_case_insensitive(self):
+        self.assertEqual(self.login("åse", "pw-Åse"), "Åse")
+        self.assertEqual(self.login("ØYVIND", "pw-Øyvind"), "Øyvind")
+        self.assertEqual(self.login("øyvind", "pw-Øyvind"), "Øyvind")
+
+    def test_non_ascii_case_variant_is_the_same_account(self):
+        with loan_app.app.app_context():
+            loan_app.db.session.add(loan_app.User(username="øyvind", password_hash="x"))
+            with self.assertRaises(IntegrityError):
+                loan_app.db.session.commit()
+            loan_app.db.session.rollback()
+
+    def test_ascii_username_is_case_insensitive(self):
+        self.assertEqual(self.login("KARI", "pw-Kari"), "Kari")
+
+
+if __name__ == "__main__":
+    unittest.main()